@@ -1,25 +1,75 @@
-"""FastAPI application exposing ggwave CLI helpers over HTTP."""
+"""FastAPI application exposing ggwave helpers over HTTP.
+
+Audio is encoded and decoded on a process pool through the ``ggwave`` Python bindings
+when they are installed. Otherwise the application falls back to the ggwave CLI tools.
+"""
 
 from __future__ import annotations
 
+import asyncio
+import io
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
 import tempfile
+import wave
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterable, Iterator
+from typing import Any, AsyncIterator, BinaryIO, Callable, Iterator, Sequence, TypeVar
 
 from fastapi import FastAPI, File, HTTPException, UploadFile
-from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 
+try:
+    import ggwave
+except ImportError:  # pragma: no cover - the CLI tools are used instead
+    ggwave = None
+
+
+T = TypeVar("T")
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 GGWAVE_ENCODE_ENV = "GGWAVE_ENCODE"
 GGWAVE_DECODE_ENV = "GGWAVE_DECODE"
-
-DECODE_PATTERN = re.compile(r"\[\+] Decoded message with length \d+: '(.+?)'")
+CORS_ORIGINS_ENV = "ALAI_CORS_ORIGINS"
+TMPDIR_ENV = "ALAI_TMPDIR"
+ENCODER_NAMES = ("ggwave-to-file",)
+DECODER_NAMES = ("ggwave-from-file",)
+# Point this at a tmpfs such as /dev/shm so CLI temp files never reach the disk.
+TEMP_DIR = os.environ.get(TMPDIR_ENV) or tempfile.gettempdir()
+
+DECODE_MARKER = b"Decoded message with length"
+DECODE_PATTERN = re.compile(rb"Decoded message with length \d+: '(.+)'")
+
+GGWAVE_PROTOCOL_ID = 1
+GGWAVE_VOLUME = 20
+GGWAVE_SAMPLE_RATE = 48000
+# ggwave crashes the process for capture rates outside this range.
+GGWAVE_MIN_SAMPLE_RATE = 1000
+GGWAVE_MAX_SAMPLE_RATE = 96000
+# Longer payloads are silently truncated by ggwave.
+GGWAVE_MAX_PAYLOAD_SIZE = 140
+GGWAVE_SAMPLE_FORMAT_I16 = 4  # ggwave_SampleFormat.GGWAVE_SAMPLE_FORMAT_I16
+GGWAVE_OPERATING_MODE_RX = 1 << 1
+GGWAVE_OPERATING_MODE_TX = 1 << 2
+WAV_SAMPLE_WIDTH = 2
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_SIZE = 32 * 1024 * 1024
+# CLI output below this size is sent as a plain response rather than streamed.
+DIRECT_RESPONSE_MAX_SIZE = 1_000_000
+ENCODE_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# Pipe buffer for CLI output; large enough that a multi-hundred-KB WAV does not keep
+# pausing and resuming the transport at asyncio's 64 KiB default.
+PIPE_BUFFER_LIMIT = 1024 * 1024
 
 
 class EncodeRequest(BaseModel):
@@ -65,11 +115,14 @@ def _possible_binary_names(name: str) -> list[str]:
     return sorted(variants)
 
 
-def _ensure_cli_found(*, env_var: str, names: Iterable[str]) -> Path:
-    """Locate a ggwave CLI executable.
+@lru_cache(maxsize=None)
+def _resolve_cli_path(env_var: str, names: tuple[str, ...]) -> Path:
+    """Locate a ggwave CLI executable, raising an HTTP error when none is found.
 
     The lookup order honours the provided environment variable first, followed by a
-    set of well-known build directories and finally the user's ``PATH``.
+    set of well-known build directories and finally the user's ``PATH``. Every
+    candidate is checked once; the result is memoized until a cached executable
+    disappears.
     """
 
     override = os.environ.get(env_var)
@@ -108,20 +161,101 @@ def _ensure_cli_found(*, env_var: str, names: Iterable[str]) -> Path:
     )
 
 
-def _run_cli(command: Iterable[str], *, input_data: bytes | None = None) -> subprocess.CompletedProcess[bytes]:
+async def _spawn_cli(command: Sequence[str]) -> asyncio.subprocess.Process:
     try:
-        return subprocess.run(
-            list(command),
-            input=input_data,
-            check=True,
-            capture_output=True,
+        return await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=PIPE_BUFFER_LIMIT,
         )
     except FileNotFoundError as exc:  # pragma: no cover - file missing is handled as runtime error
+        # The cached executable went away; look it up again on the next request.
+        _resolve_cli_path.cache_clear()
         raise HTTPException(status_code=500, detail=f"Executable not found: {command!r}") from exc
-    except subprocess.CalledProcessError as exc:
-        stderr = (exc.stderr or b"").decode("utf-8", errors="ignore").strip()
-        detail = stderr or f"Command '{' '.join(map(str, command))}' failed with exit code {exc.returncode}"
-        raise HTTPException(status_code=500, detail=detail) from exc
+
+
+async def _terminate(proc: asyncio.subprocess.Process) -> None:
+    if proc.returncode is None:
+        proc.kill()
+        await proc.wait()
+
+
+def _cli_failure(command: Sequence[str], returncode: int, stderr: bytes) -> HTTPException:
+    detail = stderr.decode("utf-8", errors="ignore").strip()
+    detail = detail or f"Command '{' '.join(command)}' failed with exit code {returncode}"
+    return HTTPException(status_code=500, detail=detail)
+
+
+async def _run_cli_async(
+    command: Sequence[str], *, input_data: bytes | None = None
+) -> subprocess.CompletedProcess[bytes]:
+    """Run a CLI tool without blocking the event loop and capture its output."""
+
+    proc = await _spawn_cli(command)
+    try:
+        stdout, stderr = await proc.communicate(input_data)
+    except asyncio.CancelledError:
+        await _terminate(proc)
+        raise
+
+    if proc.returncode:
+        raise _cli_failure(command, proc.returncode, stderr)
+    return subprocess.CompletedProcess(command, proc.returncode, stdout, stderr)
+
+
+async def _stream_cli_output(
+    command: Sequence[str], *, input_data: bytes, buffer_size: int
+) -> bytes | AsyncIterator[bytes]:
+    """Run a CLI tool and return its stdout.
+
+    Up to ``buffer_size`` bytes are read before returning. Output that fits is returned
+    whole; anything larger comes back as an iterator that streams the rest as it is
+    produced. Either way a tool failing up front is still reported as an HTTP error
+    instead of an empty ``200`` response.
+    """
+
+    proc = await _spawn_cli(command)
+    assert proc.stdin is not None and proc.stdout is not None and proc.stderr is not None
+    # Drain stderr concurrently so a chatty tool cannot block on a full pipe.
+    stderr_task = asyncio.create_task(proc.stderr.read())
+
+    try:
+        try:
+            proc.stdin.write(input_data)
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the tool exited early; its exit status is reported below
+        proc.stdin.close()
+
+        head = bytearray()
+        while len(head) < buffer_size:
+            chunk = await proc.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                stderr = await stderr_task
+                returncode = await proc.wait()
+                if returncode or not head:
+                    raise _cli_failure(command, returncode, stderr)
+                return bytes(head)
+            head += chunk
+    except BaseException:
+        stderr_task.cancel()
+        await _terminate(proc)
+        raise
+
+    async def body() -> AsyncIterator[bytes]:
+        try:
+            chunk = bytes(head)
+            while chunk:
+                yield chunk
+                chunk = await proc.stdout.read(CHUNK_SIZE)
+            await proc.wait()
+        finally:
+            stderr_task.cancel()
+            await _terminate(proc)
+
+    return body()
 
 
 def _remove_file(path: Path) -> None:
@@ -131,21 +265,282 @@ def _remove_file(path: Path) -> None:
         pass
 
 
-encoder_path = _ensure_cli_found(env_var=GGWAVE_ENCODE_ENV, names=["ggwave-to-file", "ggwave-cli"])
-decoder_path = _ensure_cli_found(env_var=GGWAVE_DECODE_ENV, names=["ggwave-from-file"])
+def _native_parameters(*, operating_mode: int, sample_rate: float = GGWAVE_SAMPLE_RATE) -> dict[str, Any]:
+    """Return ggwave parameters exchanging 16-bit PCM, the sample format of WAV payloads.
+
+    Instances only allocate the buffers for the requested ``operating_mode``.
+    """
+
+    parameters = ggwave.getDefaultParameters()
+    parameters["sampleRateInp"] = float(sample_rate)
+    parameters["sampleRateOut"] = float(GGWAVE_SAMPLE_RATE)
+    parameters["sampleFormatInp"] = GGWAVE_SAMPLE_FORMAT_I16
+    parameters["sampleFormatOut"] = GGWAVE_SAMPLE_FORMAT_I16
+    parameters["operatingMode"] = operating_mode
+    return parameters
+
+
+def _resolve_encoder_path() -> Path:
+    return _resolve_cli_path(GGWAVE_ENCODE_ENV, ENCODER_NAMES)
+
+
+def _resolve_decoder_path() -> Path:
+    return _resolve_cli_path(GGWAVE_DECODE_ENV, DECODER_NAMES)
 
-app = FastAPI(title="ALAI ggwave helpers")
 
+if ggwave is None:
+    # Resolve once at import so requests never walk the search path themselves.
+    _resolve_encoder_path()
+    _resolve_decoder_path()
+
+
+# ggwave encoder instance owned by the current worker process; see _init_worker.
+_worker_encoder: int | None = None
+
+
+def _init_worker() -> None:
+    """Prepare a pool process with its own long-lived ggwave encoder instance."""
+
+    global _worker_encoder
+    ggwave.disableLog()
+    _worker_encoder = ggwave.init(_native_parameters(operating_mode=GGWAVE_OPERATING_MODE_TX))
+
+
+def _create_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    )
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Run native ggwave work on a process pool for the lifetime of the app.
+
+    ggwave holds the GIL while it encodes or decodes, so threads would serialize on
+    it; separate processes let concurrent requests use every core.
+    """
+
+    if ggwave is None:
+        yield
+        return
+
+    app.state.ggwave_pool = _create_pool()
+    try:
+        yield
+    finally:
+        app.state.ggwave_pool.shutdown(cancel_futures=True)
+
+
+# Parsed once; a frozenset keeps the per-request origin check a hash lookup.
+_default_origins = frozenset(
+    origin.strip()
+    for origin in os.environ.get(
+        CORS_ORIGINS_ENV, "http://localhost:5173,http://127.0.0.1:5173"
+    ).split(",")
+    if origin.strip()
+)
+
+app = FastAPI(title="ALAI ggwave helpers", lifespan=_lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=_default_origins,
+    allow_methods=["POST"],
+    allow_headers=["Content-Type"],
+)
+
+
+def _encode_native(text: str) -> bytes:
+    """Encode ``text`` and return a complete WAV file. Runs in a pool process."""
+
+    waveform = ggwave.encode(
+        text,
+        protocolId=GGWAVE_PROTOCOL_ID,
+        volume=GGWAVE_VOLUME,
+        instance=_worker_encoder,
+    )
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(WAV_SAMPLE_WIDTH)
+        wav_file.setframerate(GGWAVE_SAMPLE_RATE)
+        wav_file.writeframes(waveform)
+    return buffer.getvalue()
+
+
+class _EncodeCache:
+    """LRU cache of encoded WAV payloads, bounded by their total size in bytes.
+
+    ggwave output only depends on the text for a fixed protocol and volume, so
+    repeated messages and client retries can skip the encoder entirely.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+
+    def get(self, text: str) -> bytes | None:
+        wav = self._entries.get(text)
+        if wav is not None:
+            self._entries.move_to_end(text)
+        return wav
+
+    def put(self, text: str, wav: bytes) -> None:
+        if len(wav) > self.max_size or text in self._entries:
+            return
+        self._entries[text] = wav
+        self.size += len(wav)
+        while self.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+_encode_cache = _EncodeCache(ENCODE_CACHE_MAX_SIZE)
+
+
+async def _run_native(func: Callable[..., T], *args: Any) -> T:
+    """Run ``func`` on the ggwave pool, replacing the pool if a worker died."""
+
+    pool = app.state.ggwave_pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool as exc:
+        # A broken pool rejects all further work; swap it out once, even when
+        # several requests notice the breakage at the same time.
+        if app.state.ggwave_pool is pool:
+            app.state.ggwave_pool = _create_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(status_code=500, detail="The ggwave worker process crashed.") from exc
+
+
+async def _encode_cached(text: str) -> bytes:
+    wav = _encode_cache.get(text)
+    if wav is None:
+        wav = await _run_native(_encode_native, text)
+        _encode_cache.put(text, wav)
+    return wav
+
+
+def _read_wav(audio: BinaryIO) -> tuple[int, bytes]:
+    """Return the sample rate and PCM frames of an uploaded WAV file."""
+
+    try:
+        with wave.open(audio, "rb") as wav_file:
+            if wav_file.getnchannels() != 1 or wav_file.getsampwidth() != WAV_SAMPLE_WIDTH:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Uploaded audio must be a mono 16-bit PCM WAV file.",
+                )
+            sample_rate = wav_file.getframerate()
+            if not GGWAVE_MIN_SAMPLE_RATE <= sample_rate <= GGWAVE_MAX_SAMPLE_RATE:
+                raise HTTPException(
+                    status_code=400,
+                    detail=(
+                        f"Uploaded audio must be sampled between {GGWAVE_MIN_SAMPLE_RATE} and"
+                        f" {GGWAVE_MAX_SAMPLE_RATE} Hz."
+                    ),
+                )
+            return sample_rate, wav_file.readframes(wav_file.getnframes())
+    except (wave.Error, EOFError, RuntimeError) as exc:
+        # wave raises a bare RuntimeError for some malformed chunk headers.
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid WAV file.") from exc
+
+
+def _decode_native(sample_rate: int, frames: bytes) -> str | None:
+    """Decode 16-bit PCM frames, returning ``None`` when no message was found.
+
+    Runs in a pool process.
+    """
+
+    # A fresh instance per upload keeps receiver state from leaking between requests;
+    # a receive-only instance is cheap enough to set up that pooling is not worth it.
+    instance = ggwave.init(
+        _native_parameters(operating_mode=GGWAVE_OPERATING_MODE_RX, sample_rate=sample_rate)
+    )
+    try:
+        decoded = ggwave.decode(instance, frames)
+    finally:
+        ggwave.free(instance)
+
+    if decoded is None:
+        return None
+    return decoded.decode("utf-8", errors="ignore")
+
+
+def _parse_decoder_output(output: bytes) -> str | None:
+    """Extract the message from ggwave-from-file output.
+
+    The result line comes after the tool's progress log, so locate the last marker
+    and match the bytes pattern there; only the captured message is decoded.
+    """
+
+    position = output.rfind(DECODE_MARKER)
+    if position < 0:
+        return None
+    match = DECODE_PATTERN.match(output, position)
+    if not match:
+        return None
+    return match.group(1).decode("utf-8", errors="ignore")
+
+
+def _upload_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Uploaded WAV file exceeds the {MAX_UPLOAD_SIZE // (1024 * 1024)} MiB limit.",
+    )
+
+
+def _spool_upload(upload: BinaryIO) -> Path:
+    """Copy an upload to a temporary WAV file, enforcing :data:`MAX_UPLOAD_SIZE`.
+
+    Blocking; call it through the threadpool.
+    """
+
+    with tempfile.NamedTemporaryFile(dir=TEMP_DIR, suffix=".wav", delete=False) as tmp_file:
+        tmp_path = Path(tmp_file.name)
+        try:
+            written = 0
+            while chunk := upload.read(CHUNK_SIZE):
+                written += len(chunk)
+                if written > MAX_UPLOAD_SIZE:
+                    raise _upload_too_large()
+                tmp_file.write(chunk)
+        except BaseException:
+            tmp_file.close()
+            _remove_file(tmp_path)
+            raise
+    return tmp_path
+
+
+def _wav_response(audio: bytes | AsyncIterator[bytes]) -> Response:
+    """Send a buffered WAV payload in one piece and stream anything still being produced."""
+
+    headers = {"Content-Disposition": 'attachment; filename="payload.wav"'}
+    if isinstance(audio, bytes):
+        return Response(content=audio, media_type="audio/wav", headers=headers)
+    return StreamingResponse(audio, media_type="audio/wav", headers=headers)
+
+
+def _build_encode_command(text: str) -> tuple[list[str], bytes]:
+    """Return a command writing the WAV payload to stdout, and the stdin it expects."""
 
-def _build_encode_command(text: str, output_path: Path) -> tuple[list[str], bytes | None]:
     if not text:
         raise HTTPException(status_code=400, detail="Text to encode must not be empty.")
 
+    encoder_path = _resolve_encoder_path()
     executable = encoder_path.name.lower()
     if "ggwave-to-file" in executable:
-        return [str(encoder_path), text, str(output_path)], None
-    if "ggwave-cli" in executable:
-        return [str(encoder_path), "--output", str(output_path)], text.encode("utf-8")
+        # ggwave-to-file reads a single line from stdin and would drop the rest.
+        if "\n" in text or "\r" in text:
+            raise HTTPException(
+                status_code=400,
+                detail="Text to encode must be a single line when using the ggwave CLI.",
+            )
+        return [str(encoder_path)], text.encode("utf-8") + b"\n"
 
     raise HTTPException(
         status_code=500,
@@ -155,31 +550,28 @@ def _build_encode_command(text: str, output_path: Path) -> tuple[list[str], byte
 
 @app.post(
     "/encode",
-    response_class=StreamingResponse,
+    response_class=Response,
+    responses={200: {"content": {"audio/wav": {}}, "description": "The encoded WAV payload."}},
     summary="Encode text into an ultrasonic WAV payload",
 )
-async def encode(payload: EncodeRequest) -> StreamingResponse:
+async def encode(payload: EncodeRequest) -> Response:
     text = payload.stripped_text
     if not text:
         raise HTTPException(status_code=400, detail="Text to encode must not be empty.")
+    if len(text.encode("utf-8")) > GGWAVE_MAX_PAYLOAD_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Text to encode must be at most {GGWAVE_MAX_PAYLOAD_SIZE} bytes of UTF-8.",
+        )
 
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_file:
-        tmp_path = Path(tmp_file.name)
-
-    try:
-        command, input_data = _build_encode_command(text, tmp_path)
-        _run_cli(command, input_data=input_data)
+    if ggwave is not None:
+        return _wav_response(await _encode_cached(text))
 
-        audio_file = tmp_path.open("rb")
-        try:
-            response = StreamingResponse(audio_file, media_type="audio/wav")
-            response.headers["Content-Disposition"] = 'attachment; filename="payload.wav"'
-            return response
-        except Exception:
-            audio_file.close()
-            raise
-    finally:
-        _remove_file(tmp_path)
+    command, input_data = _build_encode_command(text)
+    audio = await _stream_cli_output(
+        command, input_data=input_data, buffer_size=DIRECT_RESPONSE_MAX_SIZE
+    )
+    return _wav_response(audio)
 
 
 @app.post(
@@ -188,27 +580,36 @@ async def encode(payload: EncodeRequest) -> StreamingResponse:
     summary="Decode an ultrasonic WAV payload into text",
 )
 async def decode(file: UploadFile = File(..., description="WAV file generated by ggwave.")) -> PlainTextResponse:
-    contents = await file.read()
-    if not contents:
+    if file.size == 0:
         raise HTTPException(status_code=400, detail="Uploaded WAV file was empty.")
-
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_file:
-        tmp_file.write(contents)
-        tmp_path = Path(tmp_file.name)
-
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise _upload_too_large()
+
+    # The upload is already spooled by the multipart parser, possibly to disk; its PCM
+    # frames are read off the event loop and shipped to the pool.
+    if ggwave is not None:
+        sample_rate, frames = await run_in_threadpool(_read_wav, file.file)
+        message = await _run_native(_decode_native, sample_rate, frames)
+        if message is None:
+            raise HTTPException(
+                status_code=400,
+                detail="Could not decode a message from the provided audio.",
+            )
+        return PlainTextResponse(content=message)
+
+    # ggwave-from-file seeks within its input, so it needs a real file rather than a pipe.
+    tmp_path = await run_in_threadpool(_spool_upload, file.file)
     try:
-        result = _run_cli([str(decoder_path), str(tmp_path)])
+        result = await _run_cli_async([str(_resolve_decoder_path()), str(tmp_path)])
     finally:
-        _remove_file(tmp_path)
+        await run_in_threadpool(_remove_file, tmp_path)
 
-    decoded_output = result.stdout.decode("utf-8", errors="ignore")
-    match = DECODE_PATTERN.search(decoded_output)
-    if not match:
+    message = _parse_decoder_output(result.stdout)
+    if message is None:
         raise HTTPException(
             status_code=400,
             detail="Could not decode a message from the provided audio.",
         )
 
-    message = match.group(1)
     return PlainTextResponse(content=message)
 